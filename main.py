@@ -1,29 +1,45 @@
 # main.py
 import os
+import time
 import logging
 import asyncio
-import nest_asyncio
+import re
+import hmac
+import signal
 from datetime import datetime, date, timedelta
 from uuid import uuid4
+from functools import lru_cache
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Tuple, Optional
 
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import orjson
+import tornado.web
+import redis.asyncio as aioredis
+
+try:
+    import uvloop  # faster event loop; POSIX only, so optional
+except ImportError:
+    uvloop = None
 
-from flask import Flask, request
 from dotenv import load_dotenv
 
 from telegram import (
     Update,
+    ChatMember,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     filters,
 )
 
@@ -35,6 +51,9 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
 )
 log = logging.getLogger(__name__)
+# httpx logs every Bot API call and tornado every webhook hit at INFO; only keep their warnings
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("tornado.access").setLevel(logging.WARNING)
 
 # -----------------------------------------------------------------------------
 # Env / Globals
@@ -44,21 +63,71 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
 GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID", "")
 GOOGLE_CREDENTIALS_PATH = os.getenv("GOOGLE_CREDENTIALS_PATH", "/etc/secrets/credentials.json")
+SHEET_CACHE_TTL = float(os.getenv("SHEET_CACHE_TTL", "30"))  # seconds
+REDIS_URL = os.getenv("REDIS_URL", "")  # optional: persist pending approvals across restarts
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # optional: enables /metrics behind "Authorization: Bearer <token>"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # optional: Telegram echoes it in X-Telegram-Bot-Api-Secret-Token
+PENDING_TTL = 24 * 3600  # seconds an unanswered approval stays valid
+SHEET_WRITE_QUEUE_SIZE = 100
+ADMINS_CACHE_TTL = 300  # seconds a group's admin list is reused
+USER_STATE_TTL = 900  # seconds an idle flow is kept before it is swept
 
 if not BOT_TOKEN or not WEBHOOK_URL or not GOOGLE_SHEET_ID:
     log.warning("Environment variables missing. BOT_TOKEN/WEBHOOK_URL/GOOGLE_SHEET_ID are required.")
 
-app = Flask(__name__)
-
 telegram_app = None
 worksheet = None
+redis_client = None  # set in init_app when REDIS_URL is configured
+
+# Sheet snapshot: rows + build_sheet_index() output, refreshed after SHEET_CACHE_TTL.
+# gen is bumped when an append fails; rows queued against an older gen are never written.
+_sheet_cache: Dict[str, Any] = {"ts": 0.0, "rows": None, "index": None, "gen": 0}
 
-# Async infra
-loop = asyncio.new_event_loop()
+# gspread is blocking; reads and writes run here so the event loop keeps serving updates
+sheets_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sheets")
+# Held from balance read until the rows are queued, so concurrent approvals can't both build on the same Final Off;
+# snapshot refetches take it too
+sheet_write_lock = asyncio.Lock()
+# (gen, rows, future) waiting for sheet_writer; bounded so a Sheets outage pushes back on approvals
+_write_q: asyncio.Queue = asyncio.Queue(maxsize=SHEET_WRITE_QUEUE_SIZE)
+
+# group_id -> (fetched_at, admins)
+_admins_cache: Dict[int, Tuple[float, list]] = {}
 
 # In-memory state
 user_state: Dict[int, Dict[str, Any]] = {}
-pending_payloads: Dict[str, Dict[str, Any]] = {}  # key -> payload for admin approve/deny
+pending_payloads: Dict[str, Tuple[float, Dict[str, Any]]] = {}  # key -> (expires_at, payload) for admin approve/deny
+
+# -----------------------------------------------------------------------------
+# Helpers: RPC timings (served on /metrics)
+# -----------------------------------------------------------------------------
+TIMING_WINDOW = 1000  # most recent samples kept per operation
+
+_timings: Dict[str, deque] = {}
+_timing_counts: Dict[str, int] = {}  # all-time call counts
+
+@contextmanager
+def timed(op: str):
+    """Record how long the wrapped external call took under `op`."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timings.setdefault(op, deque(maxlen=TIMING_WINDOW)).append(time.perf_counter() - t0)
+        _timing_counts[op] = _timing_counts.get(op, 0) + 1
+
+def render_metrics() -> str:
+    """Prometheus text format: p50/p95/p99 over the recent window plus an all-time call count per op."""
+    out = [
+        "# HELP oil_rpc_seconds Latency of Sheets and Telegram calls (recent window).",
+        "# TYPE oil_rpc_seconds summary",
+    ]
+    for op, samples in sorted(_timings.items()):
+        vals = sorted(samples)
+        for q in (0.5, 0.95, 0.99):
+            out.append(f'oil_rpc_seconds{{op="{op}",quantile="{q}"}} {vals[min(len(vals) - 1, int(q * len(vals)))]:.6f}')
+        out.append(f'oil_rpc_seconds_count{{op="{op}"}} {_timing_counts[op]}')
+    return "\n".join(out) + "\n"
 
 # -----------------------------------------------------------------------------
 # Helpers: Google Sheets
@@ -66,46 +135,130 @@ pending_payloads: Dict[str, Dict[str, Any]] = {}  # key -> payload for admin app
 def gsheet_init():
     global worksheet
     log.info("🔐 Connecting to Google Sheets…")
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDENTIALS_PATH, scope)
-    client = gspread.authorize(creds)
+    client = gspread.service_account(filename=GOOGLE_CREDENTIALS_PATH)
     worksheet = client.open_by_key(GOOGLE_SHEET_ID).sheet1
     log.info("✅ Google Sheets ready.")
 
-def get_all_rows() -> List[List[str]]:
+# Sheet columns (0-based), in the order append_row writes them
+COL_TS = 0
+COL_TG_ID = 1
+COL_NAME = 2
+COL_ACTION = 3
+COL_CURRENT = 4
+COL_DELTA = 5
+COL_FINAL = 6
+COL_APPROVER = 7
+COL_APP_DATE = 8
+COL_REMARKS = 9
+COL_HOLIDAY = 10
+COL_PH_TOTAL = 11
+COL_EXPIRY = 12
+# Only the columns above are ever read; anything added to the right of M is not downloaded
+SHEET_RANGE = "A:M"
+SHEET_WIDTH = COL_EXPIRY + 1
+
+def _safe_float(s: str) -> float:
     try:
-        return worksheet.get_all_values()
+        return float(s)
+    except (TypeError, ValueError):
+        return 0.0
+
+def build_sheet_index(rows: List[List[str]]) -> Dict[str, Any]:
+    """
+    One pass over the sheet:
+      by_user: Telegram ID -> that user's rows (sheet order)
+      last_final_by_user: Telegram ID -> Final Off of the user's last row
+    Short rows (Sheets trims trailing blanks) are padded in place to SHEET_WIDTH,
+    so readers can index any column without length checks.
+    """
+    by_user: Dict[str, List[List[str]]] = {}
+    last_final_by_user: Dict[str, float] = {}
+    for r in rows[1:]:
+        if len(r) < SHEET_WIDTH:
+            r.extend([""] * (SHEET_WIDTH - len(r)))
+        tg_id = r[COL_TG_ID]
+        if not tg_id:
+            continue
+        by_user.setdefault(tg_id, []).append(r)
+        last_final_by_user[tg_id] = _safe_float(r[COL_FINAL])
+    return {"by_user": by_user, "last_final_by_user": last_final_by_user}
+
+def _snapshot_fresh() -> bool:
+    return _sheet_cache["rows"] is not None and time.monotonic() - _sheet_cache["ts"] < SHEET_CACHE_TTL
+
+async def _refresh_sheet_locked():
+    """Refetch a stale snapshot. Caller holds sheet_write_lock."""
+    if _snapshot_fresh():
+        return
+    # Let queued rows land first, otherwise the fetch could come back without them
+    await _write_q.join()
+    now = time.monotonic()
+    try:
+        with timed("sheets_get_values"):
+            rows = await asyncio.get_running_loop().run_in_executor(sheets_pool, worksheet.get_values, SHEET_RANGE)
     except Exception:
         log.exception("Failed to read sheet")
-        return []
+        return
+    _sheet_cache.update(ts=now, rows=rows, index=build_sheet_index(rows))
+
+async def _snapshot_for_write():
+    """Refresh under sheet_write_lock, refusing to build balances without a snapshot that really loaded."""
+    await _refresh_sheet_locked()
+    if _sheet_cache["rows"] is None:
+        raise RuntimeError("sheet snapshot unavailable")
+
+async def refresh_sheet():
+    """
+    Bring _sheet_cache up to date before reading it. The fetch runs in
+    sheets_pool, and callers that miss together share a single fetch.
+    Our own appends are written through (see _cache_append), so the TTL only
+    bounds how long edits made directly in the sheet take to show up.
+    """
+    if _snapshot_fresh():
+        return
+    async with sheet_write_lock:
+        await _refresh_sheet_locked()
+
+# The readers below only look at the snapshot; await refresh_sheet() first
+def get_all_rows() -> List[List[str]]:
+    return _sheet_cache["rows"] or []
+
+def get_sheet_index() -> Dict[str, Any]:
+    return _sheet_cache["index"] or build_sheet_index([])
+
+def _cache_append(row: List[str]):
+    """Mirror a successful append into the cached snapshot."""
+    if _sheet_cache["rows"] is None:
+        return
+    _sheet_cache["rows"].append(row)
+    index = _sheet_cache["index"]
+    tg_id = row[COL_TG_ID]
+    index["by_user"].setdefault(tg_id, []).append(row)
+    index["last_final_by_user"][tg_id] = _safe_float(row[COL_FINAL])
+
+def get_user_rows(user_id: str) -> List[List[str]]:
+    return get_sheet_index()["by_user"].get(str(user_id), [])
 
 def last_off_for_user(user_id: str) -> float:
     """Return latest Final Off for a user (normal off balance)."""
-    rows = get_all_rows()
-    urows = [r for r in rows if len(r) > 1 and r[1] == str(user_id)]
-    if not urows:
-        return 0.0
-    try:
-        return float(urows[-1][6])  # column G Final Off
-    except Exception:
-        return 0.0
+    return get_sheet_index()["last_final_by_user"].get(str(user_id), 0.0)
 
-def compute_ph_entries_active(user_id: str) -> Tuple[float, List[Dict[str, Any]]]:
+def compute_ph_entries_active(user_id: str, rows: Optional[List[List[str]]] = None) -> Tuple[float, List[Dict[str, Any]]]:
     """
     Return (ph_total_left, active_entries_list).
     active_entries_list: list of dicts with keys: date, expiry, reason, qty
     Logic: FIFO across rows marked Holiday Off == 'Yes'.
+    rows: this user's rows from the snapshot index (padded, no header); defaults to get_user_rows(user_id).
     """
-    rows = get_all_rows()
+    if rows is None:
+        rows = get_user_rows(user_id)
     ph_events = []
-    for r in rows[1:]:
-        if len(r) < 13:
-            continue
-        rid, action = r[1], r[3]
-        is_ph = (len(r) >= 11 and (r[10].strip().lower() in ("yes", "y", "true", "1")))  # K: Holiday Off
-        if rid != str(user_id) or not is_ph:
+    for r in rows:
+        action = r[COL_ACTION]
+        is_ph = r[COL_HOLIDAY].strip().lower() in ("yes", "y", "true", "1")
+        if not is_ph:
             continue
-        qty_raw = r[5].strip() if len(r) > 5 else ""
+        qty_raw = r[COL_DELTA].strip()
         qty = 0.0
         if qty_raw:
             try:
@@ -114,9 +267,9 @@ def compute_ph_entries_active(user_id: str) -> Tuple[float, List[Dict[str, Any]]
                 qty = 0.0
             if qty_raw.startswith("-"):
                 qty = -abs(qty)
-        app_date = r[8].strip() if len(r) > 8 else ""
-        expiry = r[12].strip() if len(r) > 12 else ""
-        reason = r[9].strip() if len(r) > 9 else ""  # J remarks
+        app_date = r[COL_APP_DATE].strip()
+        expiry = r[COL_EXPIRY].strip()
+        reason = r[COL_REMARKS].strip()
         ph_events.append({
             "action": action,
             "qty": qty,
@@ -154,7 +307,7 @@ def compute_ph_entries_active(user_id: str) -> Tuple[float, List[Dict[str, Any]]
     total_left = sum(c["qty"] for c in active)
     return (round(total_left, 3), active)
 
-def append_row(
+def build_row(
     user_id: str,
     user_name: str,
     action: str,
@@ -169,7 +322,7 @@ def append_row(
     expiry: Optional[str]
 ):
     """
-    Append one row in this order (matching your current sheet):
+    Build one sheet row in this order (matching your current sheet):
     A Time Stamp (now)
     B Telegram ID
     C Name
@@ -184,7 +337,7 @@ def append_row(
     L PH Off Total (number)
     M Expiry (YYYY-MM-DD or '')
     """
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    now = datetime.now().isoformat(sep=" ", timespec="seconds")
     row = [
         now,                               # A Time Stamp
         str(user_id),                      # B
@@ -200,17 +353,131 @@ def append_row(
         f"{ph_total:.1f}" if is_ph else "",# L
         expiry or ""                       # M
     ]
-    worksheet.append_row(row)
+    return row
+
+async def queue_rows(rows: List[List[str]]) -> asyncio.Future:
+    """
+    Hand rows built by build_row to sheet_writer and return a future that
+    resolves once they are in the sheet. The snapshot is updated right away,
+    so balance reads made after this call already see the rows.
+    """
+    fut = asyncio.get_running_loop().create_future()
+    if not rows:
+        fut.set_result(None)
+        return fut
+    gen = _sheet_cache["gen"]
+    for row in rows:
+        _cache_append(row)
+    await _write_q.put((gen, rows, fut))
+    return fut
+
+async def sheet_writer():
+    """
+    Single consumer for _write_q. Whatever queued up while the previous
+    write was in flight goes out as one append_rows call, so a burst of
+    approvals costs one Sheets request instead of one each.
+
+    Rows queued before a failed append may have been computed on top of the
+    rows that failed, so they are failed too rather than written.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await _write_q.get()]
+        while not _write_q.empty():
+            items.append(_write_q.get_nowait())
+        gen = _sheet_cache["gen"]
+        live = [(rows, fut) for g, rows, fut in items if g == gen]
+        try:
+            for g, _, fut in items:
+                if g != gen and not fut.done():
+                    fut.set_exception(RuntimeError("an earlier sheet write failed"))
+            if not live:
+                continue
+            batch = [row for rows, _ in live for row in rows]
+            try:
+                with timed("sheets_append_rows"):
+                    await loop.run_in_executor(sheets_pool, worksheet.append_rows, batch)
+            except Exception as e:
+                # Drop the snapshot holding the unwritten rows; writes need a fresh fetch now
+                _sheet_cache.update(gen=gen + 1, ts=0.0, rows=None, index=None)
+                for _, fut in live:
+                    if not fut.done():
+                        fut.set_exception(e)
+            else:
+                for _, fut in live:
+                    if not fut.done():
+                        fut.set_result(None)
+        finally:
+            for _ in items:
+                _write_q.task_done()
+
+# -----------------------------------------------------------------------------
+# Helpers: pending approvals & flow state
+# -----------------------------------------------------------------------------
+# user_state stays in-process: it holds date objects, is mutated on every
+# step and is cheap to lose. Approval payloads are what a restart must not
+# drop, so they go to Redis when it is configured.
+async def pending_put(key: str, payload: Dict[str, Any]):
+    if redis_client is None:
+        # Same TTL as Redis, so requests nobody answers don't pile up in memory
+        now = time.monotonic()
+        for k in [k for k, (exp, _) in pending_payloads.items() if exp <= now]:
+            del pending_payloads[k]
+        pending_payloads[key] = (now + PENDING_TTL, payload)
+        return
+    await redis_client.set(f"req:{key}", orjson.dumps(payload), ex=PENDING_TTL)
+
+async def pending_pop(key: str) -> Optional[Dict[str, Any]]:
+    """Take a payload out of the store; only the first approver to press gets it."""
+    if redis_client is None:
+        exp, payload = pending_payloads.pop(key, (0.0, None))
+        return payload if exp > time.monotonic() else None
+    raw = await redis_client.getdel(f"req:{key}")
+    return orjson.loads(raw) if raw else None
+
+async def sweep_user_state():
+    """Drop flows nobody has touched for USER_STATE_TTL seconds (abandoned /clockoff, /newuser, ...)."""
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        # New flows are stamped on first sight; every message/callback restamps them
+        stale = [uid for uid, st in user_state.items() if now - st.setdefault("_ts", now) > USER_STATE_TTL]
+        for uid in stale:
+            del user_state[uid]
+        if stale:
+            log.info("🧹 Swept %d idle flow(s).", len(stale))
 
 # -----------------------------------------------------------------------------
 # Helpers: Telegram UI bits
 # -----------------------------------------------------------------------------
+# Keyboards are immutable once built, so one instance per session can be resent freely
+@lru_cache(maxsize=256)
 def cancel_keyboard(session_id: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data=f"cancel|{session_id}")]])
 
+def approval_keyboard(key: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Approve", callback_data=f"approve|{key}"),
+        InlineKeyboardButton("❌ Deny", callback_data=f"deny|{key}")
+    ]])
+
 def bold(s: str) -> str:
     return f"*{s}*"
 
+MESSAGE_CHUNK_CHARS = 3500  # leaves room for headers under Telegram's 4096-char message limit
+
+def chunk_lines(lines, limit: int = MESSAGE_CHUNK_CHARS) -> List[str]:
+    """Join lines into newline-separated chunks of at most ~limit chars; always at least one chunk."""
+    chunks, buf, size = [], [], 0
+    for line in lines:
+        if buf and size + len(line) + 1 > limit:
+            chunks.append("\n".join(buf))
+            buf, size = [], 0
+        buf.append(line)
+        size += len(line) + 1
+    chunks.append("\n".join(buf))
+    return chunks
+
 # --- Quiet send helpers (group messages are silent, PMs normal) ---
 def _is_group(chat_type: str) -> bool:
     return chat_type in ("group", "supergroup")
@@ -224,20 +491,55 @@ async def send_group_quiet(context: ContextTypes.DEFAULT_TYPE, chat_id: int, tex
     kwargs.setdefault("disable_notification", True)
     return await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
 
+async def edit_quiet(q, text: str, **kwargs):
+    """Edit a callback's message, ignoring failures (message gone, text unchanged, ...)."""
+    try:
+        return await q.edit_message_text(text, **kwargs)
+    except Exception:
+        return None
+
 # -----------------------------------------------------------------------------
 # Helpers: Admin PM summary
 # -----------------------------------------------------------------------------
-def _label_from_action(action: str) -> str:
-    if action == "clockoff": return "Clock Off"
-    if action == "claimoff": return "Claim Off"
-    if action == "clockphoff": return "Clock PH Off"
-    if action == "claimphoff": return "Claim PH Off"
-    return action
+# Message bodies are formatted once per request; the same string goes to every admin
+ADMIN_SINGLE_TMPL = (
+    "🆕 *{label} Request*\n\n"
+    "👤 User: {name} ({uid})\n"
+    "📅 Days: {days}\n"
+    "🗓 Application Date: {app_date}\n"
+    "📝 Reason: {reason}\n\n"
+    "📊 Current Off: {current:.1f}\n"
+    "📈 New Balance: {final:.1f}"
+)
+ADMIN_ONBOARD_TMPL = (
+    "🔎 *Import Review*\n"
+    "👤 {name} ({uid})\n"
+    "Normal OIL days to import: {nd}\n"
+    "PH entries: {nph}{lines}"
+)
+ADMIN_MASS_TMPL = (
+    "🆕 *{label}* — Days per user: {days}\n"
+    "🗓 Date: {app_date}\n"
+    "📝 Remarks: {reason}\n\n"
+    "{listing}"
+)
+GROUP_SINGLE_APPROVED_TMPL = (
+    "✅ {name}'s {ph}{label} approved by {approver}.\n"
+    "🗓 Application Date: {app_date}\n"
+    "📅 Days: {days}\n"
+    "📝 Reason: {reason}\n"
+    "📊 Final: {final:.1f} day(s)"
+)
+
+# Labels per flow action: outcome summaries, admin request titles, and the sheet's Action column
+ACTION_LABELS = {"clockoff": "Clock Off", "claimoff": "Claim Off", "clockphoff": "Clock PH Off", "claimphoff": "Claim PH Off"}
+REQUEST_LABELS = {"clockoff": "Clock Off", "claimoff": "Claim Off", "clockphoff": "Clock Off (PH)", "claimphoff": "Claim Off (PH)"}
+SHEET_ACTIONS = {"clockoff": "Clock Off", "claimoff": "Claim Off", "clockphoff": "Clock Off", "claimphoff": "Claim Off"}
 
 def build_admin_summary_text(p: dict, approved: bool, approver_name: str, final_off: float | None) -> str:
     t = "✅ Approved" if approved else "❌ Denied"
     if p["type"] == "single":
-        label = _label_from_action(p["action"])
+        label = ACTION_LABELS.get(p["action"], p["action"])
         lines = [
             f"{t}",
             f"{label} — {p['user_name']} ({p['user_id']})",
@@ -271,20 +573,77 @@ def build_admin_summary_text(p: dict, approved: bool, approver_name: str, final_
 
     return f"{t} by {approver_name}"
 
-async def update_all_admin_pm(context: ContextTypes.DEFAULT_TYPE, payload: dict, summary_text: str):
-    for admin_id, msg_id in payload.get("admin_msgs", []):
+async def get_admins(context: ContextTypes.DEFAULT_TYPE, group_id: int) -> list:
+    """get_chat_administrators, reused for ADMINS_CACHE_TTL seconds per group."""
+    now = time.monotonic()
+    hit = _admins_cache.get(group_id)
+    if hit and now - hit[0] < ADMINS_CACHE_TTL:
+        return hit[1]
+    with timed("tg_get_chat_administrators"):
+        admins = await context.bot.get_chat_administrators(group_id)
+    _admins_cache[group_id] = (now, admins)
+    return admins
+
+_ADMIN_STATUSES = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop a group's cached admin list as soon as someone's admin status changes."""
+    cmu = update.chat_member
+    was_admin = cmu.old_chat_member.status in _ADMIN_STATUSES
+    is_admin = cmu.new_chat_member.status in _ADMIN_STATUSES
+    if was_admin != is_admin:
+        _admins_cache.pop(cmu.chat.id, None)
+
+async def pm_admins(context: ContextTypes.DEFAULT_TYPE, admins, chunks: List[str], reply_markup=None, **kwargs) -> List[Tuple[int, int]]:
+    """
+    PM every human admin concurrently (the AIORateLimiter paces the sends to
+    Telegram's limits). chunks go out in order (see chunk_lines)
+    with reply_markup on the last one. Returns (admin_id, message_id) for every
+    message sent to admins who got the whole request; an admin's last entry
+    is the one carrying the buttons.
+    """
+    async def _pm_admin(a):
+        sent = []
         try:
-            await context.bot.edit_message_text(
-                chat_id=admin_id,
-                message_id=msg_id,
-                text=summary_text
-            )
+            for i, chunk in enumerate(chunks, 1):
+                with timed("tg_send_admin_pm"):
+                    msg = await context.bot.send_message(
+                        chat_id=a.user.id, text=chunk,
+                        reply_markup=reply_markup if i == len(chunks) else None, **kwargs
+                    )
+                sent.append((a.user.id, msg.message_id))
+            return sent
+        except Exception:
+            log.warning("Could not PM admin %s", a.user.id)
+            return []
+
+    results = await asyncio.gather(*(_pm_admin(a) for a in admins if not a.user.is_bot))
+    return [ref for sent in results for ref in sent]
+
+async def update_all_admin_pm(context: ContextTypes.DEFAULT_TYPE, payload: dict, summary_text: str, skip_id: Optional[int] = None):
+    """
+    Replace every admin's request PM with the outcome; skip_id is the approver, whose PM the callback edits itself.
+    Only each admin's last message (the one with the buttons) is edited; earlier listing chunks stay as the record.
+    """
+    async def _edit_one(admin_id, msg_id):
+        try:
+            with timed("tg_edit_admin_pm"):
+                await context.bot.edit_message_text(
+                    chat_id=admin_id,
+                    message_id=msg_id,
+                    text=summary_text
+                )
         except Exception:
             try:
                 await context.bot.send_message(chat_id=admin_id, text=summary_text)
             except Exception:
                 pass
 
+    last_msg = {admin_id: msg_id for admin_id, msg_id in payload.get("admin_msgs", [])}
+    await asyncio.gather(*(
+        _edit_one(admin_id, msg_id) for admin_id, msg_id in last_msg.items() if admin_id != skip_id
+    ))
+
 # -----------------------------------------------------------------------------
 # Helpers: Calendar & Validation
 # -----------------------------------------------------------------------------
@@ -296,25 +655,54 @@ def month_add(d: date, delta_months: int) -> date:
     m = (d.month - 1 + delta_months) % 12 + 1
     return date(y, m, 1)
 
+# Calendar callbacks carry compact hex ordinals instead of ISO date strings
+_CAL_EPOCH = date(2020, 1, 1)
+
+def _pack_day(d: date) -> str:
+    return f"{(d - _CAL_EPOCH).days:x}"
+
+def _unpack_day(s: str) -> date:
+    return _CAL_EPOCH + timedelta(days=int(s, 16))
+
+def _pack_month(d: date) -> str:
+    return f"{d.year * 12 + d.month - 1:x}"
+
+def _unpack_month(s: str) -> date:
+    y, m = divmod(int(s, 16), 12)
+    return date(y, m + 1, 1)
+
+# noop cells carry no session, so every calendar can share these
+_WEEKDAY_ROW = [InlineKeyboardButton(d, callback_data="noop") for d in ("Su", "Mo", "Tu", "We", "Th", "Fr", "Sa")]
+_BLANK_BTN = InlineKeyboardButton(" ", callback_data="noop")
+_OUT_OF_RANGE_BTN = InlineKeyboardButton("·", callback_data="noop")
+
 def build_calendar(
     session_id: str,
     cur: date,
     min_date: Optional[date] = None,
     max_date: Optional[date] = None
+) -> InlineKeyboardMarkup:
+    # Only the month matters, so month-nav back and forth reuses the same markup
+    return _build_calendar_cached(session_id, month_start(cur), min_date, max_date)
+
+@lru_cache(maxsize=256)
+def _build_calendar_cached(
+    session_id: str,
+    cur: date,
+    min_date: Optional[date],
+    max_date: Optional[date]
 ) -> InlineKeyboardMarkup:
     """
     session_id ties callbacks to a user flow.
     callback_data patterns:
-      - noop|<sid>
-      - cal|<sid>|YYYY-MM-DD
-      - calnav|<sid>|YYYY-MM-01
+      - noop                  (inert cells; shared button instances)
+      - cal|<sid>|<day>       (hex days since _CAL_EPOCH)
+      - calnav|<sid>|<month>  (hex year*12 + month-1)
       - manual|<sid>
       - cancel|<sid>
     Only dates within [min_date, max_date] are clickable.
     """
-    header = [InlineKeyboardButton(f"📅 {cur.strftime('%B %Y')}", callback_data=f"noop|{session_id}")]
-    weekdays = ["Su", "Mo", "Tu", "We", "Th", "Fr", "Sa"]
-    week_hdr = [InlineKeyboardButton(d, callback_data=f"noop|{session_id}") for d in weekdays]
+    header = [InlineKeyboardButton(f"📅 {cur.strftime('%B %Y')}", callback_data="noop")]
 
     first = month_start(cur)
     start_wd = first.weekday()  # Mon=0..Sun=6
@@ -326,7 +714,7 @@ def build_calendar(
     rows = []
     row = []
     for _ in range(start_offset):
-        row.append(InlineKeyboardButton(" ", callback_data=f"noop|{session_id}"))
+        row.append(_BLANK_BTN)
     day = 1
     while day <= days_in_month:
         while len(row) < 7 and day <= days_in_month:
@@ -339,14 +727,14 @@ def build_calendar(
             if in_range:
                 row.append(InlineKeyboardButton(
                     f"{day}",
-                    callback_data=f"cal|{session_id}|{d.strftime('%Y-%m-%d')}"
+                    callback_data=f"cal|{session_id}|{_pack_day(d)}"
                 ))
             else:
-                row.append(InlineKeyboardButton("·", callback_data=f"noop|{session_id}"))
+                row.append(_OUT_OF_RANGE_BTN)
             day += 1
         if len(row) < 7:
             while len(row) < 7:
-                row.append(InlineKeyboardButton(" ", callback_data=f"noop|{session_id}"))
+                row.append(_BLANK_BTN)
         rows.append(row)
         row = []
 
@@ -356,24 +744,51 @@ def build_calendar(
     allow_next = (max_date is None) or (next_month <= date(max_date.year, max_date.month, 1))
 
     nav = [
-        InlineKeyboardButton("« Prev", callback_data=(f"calnav|{session_id}|{prev_month.strftime('%Y-%m-01')}" if allow_prev else f"noop|{session_id}")),
+        InlineKeyboardButton("« Prev", callback_data=(f"calnav|{session_id}|{_pack_month(prev_month)}" if allow_prev else "noop")),
         InlineKeyboardButton("Manual entry", callback_data=f"manual|{session_id}"),
-        InlineKeyboardButton("Next »", callback_data=(f"calnav|{session_id}|{next_month.strftime('%Y-%m-01')}" if allow_next else f"noop|{session_id}"))
+        InlineKeyboardButton("Next »", callback_data=(f"calnav|{session_id}|{_pack_month(next_month)}" if allow_next else "noop"))
     ]
     cancel = [InlineKeyboardButton("❌ Cancel", callback_data=f"cancel|{session_id}")]
 
-    keyboard = [header, week_hdr] + rows + [nav, cancel]
+    keyboard = [header, _WEEKDAY_ROW] + rows + [nav, cancel]
     return InlineKeyboardMarkup(keyboard)
 
 def validate_half_step(x: float) -> bool:
-    return abs((x * 10) % 5) < 1e-9
+    return (x * 2).is_integer()
 
-def parse_date_yyyy_mm_dd(s: str) -> Optional[str]:
+def parse_days(text: str) -> Optional[float]:
+    """'1.5' -> 1.5 when it is 0.5..3.0 in 0.5 steps, else None. Checked as whole tenths."""
     try:
-        d = datetime.strptime(s.strip(), "%Y-%m-%d").date()
-        return d.strftime("%Y-%m-%d")
-    except Exception:
+        x = float(text)
+        tenths = round(x * 10)
+    except (ValueError, OverflowError):
+        return None
+    if tenths != x * 10 or not 5 <= tenths <= 30 or tenths % 5:
         return None
+    return tenths / 10
+
+_DATE_RE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+# The same few expiry/application dates are parsed on every /summary and approval
+@lru_cache(maxsize=1024)
+def _parse_ymd(s: str) -> Optional[date]:
+    """YYYY-MM-DD -> date, or None. The regex keeps fromisoformat to the one format we accept."""
+    if not _DATE_RE.fullmatch(s):
+        return None
+    try:
+        return date.fromisoformat(s)
+    except ValueError:
+        return None
+
+def parse_date_yyyy_mm_dd(s: str) -> Optional[str]:
+    d = _parse_ymd(s.strip())
+    return d.isoformat() if d else None
+
+@lru_cache(maxsize=512)
+def expiry_from_app_date(app_date: str) -> str:
+    """PH expiry (application date + 365 days) as YYYY-MM-DD, '' if the date is invalid."""
+    d = _parse_ymd(app_date)
+    return (d + timedelta(days=365)).isoformat() if d else ""
 
 def validate_application_date(action: str, dstr: str) -> tuple[bool, str]:
     """
@@ -381,9 +796,8 @@ def validate_application_date(action: str, dstr: str) -> tuple[bool, str]:
     Clocking (clockoff/clockphoff/newuser_ph/mass): today-365 .. today
     Claiming (claimoff/claimphoff): today-365 .. today+365
     """
-    try:
-        d = datetime.strptime(dstr, "%Y-%m-%d").date()
-    except Exception:
+    d = _parse_ymd(dstr)
+    if d is None:
         return False, "Invalid date format. Please use YYYY-MM-DD."
 
     today = date.today()
@@ -448,7 +862,8 @@ async def cmd_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = str(user.id)
 
-    bal = last_off_for_user(uid)  
+    await refresh_sheet()
+    bal = last_off_for_user(uid)
     ph_total_left, active = compute_ph_entries_active(uid)
     normal_bal = bal - ph_total_left
 
@@ -458,8 +873,7 @@ async def cmd_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lines.append(f"🏖 PH Off Total: {ph_total_left:.1f} day(s)")
     if active:
         lines.append("🔎 PH Off Entries (active):")
-        for c in active:
-            lines.append(f"• {c['date']}: +{c['qty']:.1f} (exp {c['expiry']}) - {c['reason']}")
+        lines.extend(f"• {c['date']}: +{c['qty']:.1f} (exp {c['expiry']}) - {c['reason']}" for c in active)
     else:
         lines.append("🔎 PH Off Entries (active): none")
 
@@ -468,23 +882,29 @@ async def cmd_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = str(user.id)
-    rows = get_all_rows()
-    urows = [r for r in rows if len(r) > 1 and r[1] == uid]
+    await refresh_sheet()
+    urows = get_user_rows(uid)
     if not urows:
         await reply_quiet(update, "📜 No logs found.")
         return
     last5 = urows[-5:]
     out = []
     for r in last5:
-        ts = r[0] if len(r) > 0 else ""
-        action = r[3] if len(r) > 3 else ""
-        delta = r[5] if len(r) > 5 else ""
-        final = r[6] if len(r) > 6 else ""
-        remarks = r[9] if len(r) > 9 else ""
-        out.append(f"{ts} | {action} | {delta} → {final} | {remarks}")
+        out.append(f"{r[COL_TS]} | {r[COL_ACTION]} | {r[COL_DELTA]} → {r[COL_FINAL]} | {r[COL_REMARKS]}")
     await reply_quiet(update, "📜 Your last 5 OIL logs:\n\n" + "\n".join(out))
 
 # ------------------- Generic 1:1 flows (normal + PH) -------------------------
+_DAYS_PROMPT_TMPL = (
+    "{icon} How many {ph}OIL days do you want to {verb}? (0.5 to 3, in 0.5 steps)\n"
+    "– Date limits will be shown in the next step."
+)
+DAYS_PROMPTS = {
+    "clockoff": _DAYS_PROMPT_TMPL.format(icon="🕒", ph="", verb="clock"),
+    "claimoff": _DAYS_PROMPT_TMPL.format(icon="🗂", ph="", verb="claim"),
+    "clockphoff": _DAYS_PROMPT_TMPL.format(icon="🏖", ph="PH ", verb="clock"),
+    "claimphoff": _DAYS_PROMPT_TMPL.format(icon="🏖", ph="PH ", verb="claim"),
+}
+
 async def start_flow_days(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: str, action: str, is_ph: bool):
     uid = update.effective_user.id
     sid = str(uuid4())[:10]
@@ -497,14 +917,7 @@ async def start_flow_days(update: Update, context: ContextTypes.DEFAULT_TYPE, fl
         "is_ph": is_ph,
         "owner_id": uid,            # guard against cross-user presses
     }
-    icon = "🏖" if is_ph else ("🗂" if action.startswith("claim") else "🕒")
-    await reply_quiet(
-        update,
-        f"{icon} How many {'PH ' if is_ph else ''}OIL days do you want to "
-        f"{'clock' if 'clock' in action else 'claim'}? (0.5 to 3, in 0.5 steps)\n"
-        f"– Date limits will be shown in the next step.",
-        reply_markup=cancel_keyboard(sid)
-    )
+    await reply_quiet(update, DAYS_PROMPTS[action], reply_markup=cancel_keyboard(sid))
 
 async def cmd_clockoff(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await start_flow_days(update, context, "normal", "clockoff", False)
@@ -526,20 +939,19 @@ async def cmd_overview(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Run /overview in the group.")
         return
     try:
-        admins = await context.bot.get_chat_administrators(chat.id)
+        admins = await get_admins(context, chat.id)
         if update.effective_user.id not in [a.user.id for a in admins if not a.user.is_bot]:
             await reply_quiet(update, "Only admins can use this.")
             return
     except Exception:
         pass
 
+    await refresh_sheet()
     rows = get_all_rows()
     seen = {}
     for r in rows[1:]:
-        if len(r) < 3:
-            continue
-        tid = r[1].strip()
-        name = r[2].strip() or tid
+        tid = r[COL_TG_ID].strip()
+        name = r[COL_NAME].strip() or tid
         if not tid.isdigit():
             continue
         seen[tid] = name
@@ -560,20 +972,11 @@ async def cmd_overview(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             lines.append(f"• {name} ({uid}) — Total: ? | Normal: ? | PH: ?")
 
-    out = ""
-    for line in lines:
-        if len(out) + len(line) + 1 > 3500:
-            try:
-                await reply_quiet(update, out, parse_mode="Markdown")
-            except Exception:
-                await reply_quiet(update, out)
-            out = ""
-        out += (line + "\n")
-    if out:
+    for chunk in chunk_lines(lines):
         try:
-            await reply_quiet(update, out, parse_mode="Markdown")
+            await reply_quiet(update, chunk, parse_mode="Markdown")
         except Exception:
-            await reply_quiet(update, out)
+            await reply_quiet(update, chunk)
             
 # ------------------- Onboarding /newuser -------------------------------------
 
@@ -585,9 +988,8 @@ async def cmd_newuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     uid = update.effective_user.id
     sid = str(uuid4())[:10]
-    rows = get_all_rows()
-    exists = any(len(r) > 1 and r[1] == str(uid) for r in rows)
-    if exists:
+    await refresh_sheet()
+    if str(uid) in get_sheet_index()["by_user"]:
         await reply_quiet(update, "You already have records here. Import is only for brand-new users.")
         return
 
@@ -613,218 +1015,220 @@ async def cmd_newuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------------------------------------------------------------
 # Message handler (free-text steps)
 # -----------------------------------------------------------------------------
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message or not update.message.text:
+# ---- Days -> Date -> Remarks (single & mass) ----
+async def _stage_days(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any], text: str):
+    days = parse_days(text)
+    if days is None:
+        await reply_quiet(update, "❌ Invalid input. Enter 0.5 to 3.0 in 0.5 steps.", reply_markup=cancel_keyboard(st["sid"]))
         return
-    uid = update.effective_user.id
-    text = update.message.text.strip()
 
-    if text.lower() == "-quit":
-        user_state.pop(uid, None)
-        await reply_quiet(update, "🧹 Cancelled.")
-        return
+    cur = date.today()
 
-    st = user_state.get(uid)
-    if not st:
+    # Set date limits
+    past_365 = cur - timedelta(days=365)
+    if st["flow"].startswith("mass_"):
+        st.update(days=days, stage="awaiting_mass_date", min_date=past_365, max_date=cur)
+        await reply_quiet(
+            update,
+            f"{bold('📅 Select the Application Date for the mass action:')}\n"
+            f"• Tap a date below, or tap {bold('Manual entry')} to type YYYY-MM-DD.\n"
+            f"• Allowed date range (clocking): {st['min_date']} to {st['max_date']}",
+            parse_mode="Markdown",
+            reply_markup=build_calendar(st["sid"], cur, st["min_date"], st["max_date"])
+        )
         return
 
-    # ---- Days -> Date -> Remarks (single & mass) ----
-    if st["stage"] == "awaiting_days":
-        try:
-            days = float(text)
-            if days <= 0:
-                raise ValueError()
-            if st["flow"] in ("normal", "ph", "mass_normal", "mass_ph"):
-                if not (0.5 <= days <= 3.0) or not validate_half_step(days):
-                    raise ValueError()
-        except ValueError:
-            await reply_quiet(update, "❌ Invalid input. Enter 0.5 to 3.0 in 0.5 steps.", reply_markup=cancel_keyboard(st["sid"]))
+    is_claim = st.get("action") in ("claimoff", "claimphoff")
+    st.update(
+        days=days,
+        stage="awaiting_app_date",
+        min_date=past_365,
+        max_date=cur + (timedelta(days=365) if is_claim else timedelta(days=0)),
+    )
+    await reply_quiet(
+        update,
+        f"{bold('📅 Select Application Date:')}\n"
+        f"• Tap a date below, or tap {bold('Manual entry')} to type YYYY-MM-DD.\n"
+        f"• Allowed date range: {st['min_date']} to {st['max_date']}",
+        parse_mode="Markdown",
+        reply_markup=build_calendar(st["sid"], cur, st["min_date"], st["max_date"])
+    )
+
+# ---- remarks after date (single) ----
+async def _stage_reason(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any], text: str):
+    action = st.get("action","")
+    optional = action in ("claimoff", "claimphoff")
+    if optional:
+        st["reason"] = ("—" if text.lower() == "nil" or text == "" else text[:80])
+    else:
+        if not text or text.lower() == "nil":
+            await reply_quiet(update, "❌ Remarks required. Please provide a short reason (max 80 chars).", reply_markup=cancel_keyboard(st["sid"]))
             return
+        st["reason"] = text[:80]
+    await finalize_single_request(update, context, st, st.get("app_date",""))
 
-        st["days"] = days
-        cur = date.today()
+# ---- remarks after date (mass) ----
+async def _stage_mass_remarks(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any], text: str):
+    # Leave the text stage before awaiting so a second message can't build a second preview
+    st.update(reason=text[:80], stage="mass_preview")
+    await mass_preview_and_confirm(update, context, st)
 
-        # Set date limits
-        past_365 = date.today() - timedelta(days=365)
-        if st["flow"].startswith("mass_"):
-            st["stage"] = "awaiting_mass_date"
-            st["min_date"] = past_365
-            st["max_date"] = date.today()
-            await reply_quiet(
-                update,
-                f"{bold('📅 Select the Application Date for the mass action:')}\n"
-                f"• Tap a date below, or tap {bold('Manual entry')} to type YYYY-MM-DD.\n"
-                f"• Allowed date range (clocking): {st['min_date']} to {st['max_date']}",
-                parse_mode="Markdown",
-                reply_markup=build_calendar(st["sid"], cur, st["min_date"], st["max_date"])
-            )
-            return
+# ---- /newuser flow ----
+async def _stage_newuser_normal_days(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any], text: str):
+    try:
+        nd = float(text)
+        if nd < 0:
+            raise ValueError()
+    except ValueError:
+        await reply_quiet(update, "Please enter a non-negative number (e.g., 0, 6, 7.5).", reply_markup=cancel_keyboard(st["sid"]))
+        return
+    st["newuser"]["normal_days"] = nd
+    st["stage"] = "ph_ask_count"
+    await reply_quiet(
+        update,
+        "Now we’ll import *PH OIL* entries.\n"
+        "How many PH entries do you want to add? (0–10)\n"
+        "You’ll add them one-by-one with date + PH name.",
+        parse_mode="Markdown",
+        reply_markup=cancel_keyboard(st["sid"])
+    )
 
-        st["stage"] = "awaiting_app_date"
-        is_claim = st.get("action") in ("claimoff", "claimphoff")
-        st["min_date"] = past_365
-        st["max_date"] = date.today() + (timedelta(days=365) if is_claim else timedelta(days=0))
+async def _stage_newuser_ph_count(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any], text: str):
+    nu = st["newuser"]
+    try:
+        cnt = int(text)
+        if cnt < 0 or cnt > 10:
+            raise ValueError()
+    except ValueError:
+        await reply_quiet(update, "Enter an integer between 0 and 10.", reply_markup=cancel_keyboard(st["sid"]))
+        return
+    nu["ph_count"] = cnt
+    if cnt == 0:
+        st["stage"] = "review_submit"
+        await newuser_review(update, context, st)
+    else:
+        cur = date.today()
+        st.update(ph_idx=0, stage="ph_date", min_date=cur - timedelta(days=365), max_date=cur)
         await reply_quiet(
             update,
-            f"{bold('📅 Select Application Date:')}\n"
-            f"• Tap a date below, or tap {bold('Manual entry')} to type YYYY-MM-DD.\n"
-            f"• Allowed date range: {st['min_date']} to {st['max_date']}",
+            f"PH Entry 1/{nu['ph_count']} — {bold('Select Application Date')} (YYYY-MM-DD)\n"
+            f"• Allowed date range (clocking): {st['min_date']} to {st['max_date']}",
             parse_mode="Markdown",
             reply_markup=build_calendar(st["sid"], cur, st["min_date"], st["max_date"])
         )
-        return
 
-    # ---- remarks after date (single) ----
-    if st["flow"] in ("normal", "ph") and st["stage"] == "awaiting_reason":
-        txt = text.strip()
-        action = st.get("action","")
-        optional = action in ("claimoff", "claimphoff")
-        if optional:
-            st["reason"] = ("—" if txt.lower() == "nil" or txt == "" else txt[:80])
-        else:
-            if not txt or txt.lower() == "nil":
-                await reply_quiet(update, "❌ Remarks required. Please provide a short reason (max 80 chars).", reply_markup=cancel_keyboard(st["sid"]))
-                return
-            st["reason"] = txt[:80]
-        await finalize_single_request(update, context, st, st.get("app_date",""))
+async def _stage_newuser_ph_reason(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any], text: str):
+    nu = st["newuser"]
+    idx = st["ph_idx"]
+    if not text or text.lower() == "nil":
+        await reply_quiet(update, "❌ PH name is required. Please enter the PH name (e.g., National Day 2025).", reply_markup=cancel_keyboard(st["sid"]))
         return
-
-    # ---- remarks after date (mass) ----
-    if st["flow"].startswith("mass_") and st["stage"] == "awaiting_mass_remarks":
-        st["reason"] = text[:80]
-        await mass_preview_and_confirm(update, context, st)
+    nu["ph_entries"][idx]["reason"] = text[:80]
+    idx += 1
+    if idx < nu["ph_count"]:
+        cur = date.today()
+        st.update(ph_idx=idx, stage="ph_date", min_date=cur - timedelta(days=365), max_date=cur)
+        await reply_quiet(
+            update,
+            f"PH Entry {idx+1}/{nu['ph_count']} — {bold('Select Application Date')} (YYYY-MM-DD)\n"
+            f"• Allowed date range (clocking): {st['min_date']} to {st['max_date']}",
+            parse_mode="Markdown",
+            reply_markup=build_calendar(st["sid"], cur, st["min_date"], st["max_date"])
+        )
+    else:
+        st["stage"] = "review_submit"
+        await newuser_review(update, context, st)
+
+# ---- manual date entry (single) ----
+async def _stage_manual_date(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any], text: str):
+    d = parse_date_yyyy_mm_dd(text)
+    if not d:
+        await reply_quiet(update, "Invalid date. Please type YYYY-MM-DD.", reply_markup=cancel_keyboard(st["sid"]))
         return
+    ok, msg = validate_application_date(st.get("action",""), d)
+    if not ok:
+        await reply_quiet(update, msg, reply_markup=cancel_keyboard(st["sid"]))
+        return
+    st.update(app_date=d, stage="awaiting_reason")
+    if st.get("action") == "clockoff":
+        prompt = "📝 Enter clocking reason (e.g., OT number, event name)."
+    elif st.get("action") == "clockphoff":
+        prompt = "📝 Enter PH name (e.g., National Day 2025)."
+    elif st.get("action") == "claimoff":
+        prompt = "📝 Enter remarks (optional). Type 'nil' to skip."
+    else:
+        prompt = "📝 Enter remarks (optional). Type 'nil' to skip."
+    await reply_quiet(update, prompt, reply_markup=cancel_keyboard(st["sid"]))
+
+# ---- manual date entry (mass) ----
+async def _stage_mass_manual_date(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any], text: str):
+    d = parse_date_yyyy_mm_dd(text)
+    if not d:
+        await reply_quiet(update, "Invalid date. Please type YYYY-MM-DD.", reply_markup=cancel_keyboard(st["sid"]))
+        return
+    ok, msg = validate_application_date("mass", d)
+    if not ok:
+        await reply_quiet(update, msg, reply_markup=cancel_keyboard(st["sid"]))
+        return
+    st.update(app_date=d, stage="awaiting_mass_remarks")
+    await reply_quiet(update, "📝 Enter remarks for the mass action (reason or PH name).", reply_markup=cancel_keyboard(st["sid"]))
+
+# ---- manual date entry for /newuser PH step ----
+async def _stage_newuser_ph_manual_date(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any], text: str):
+    d = parse_date_yyyy_mm_dd(text)
+    if not d:
+        await reply_quiet(update, "Invalid date. Please type YYYY-MM-DD.", reply_markup=cancel_keyboard(st["sid"]))
+        return
+    ok, msg = validate_application_date("newuser_ph", d)
+    if not ok:
+        await reply_quiet(update, msg, reply_markup=cancel_keyboard(st["sid"]))
+        return
+    nu = st["newuser"]
+    idx = st.get("ph_idx", 0)
+    nu["ph_entries"].append({"date": d, "reason": None})
+    st["stage"] = "ph_reason"
+    await reply_quiet(update, f"PH Entry {idx+1}/{nu['ph_count']} — Enter {bold('PH name')} (max 80 chars):", parse_mode="Markdown", reply_markup=cancel_keyboard(st["sid"]))
+
+# Text-input stage -> handler. Stage names are unique per flow, so the stage alone picks the step;
+# stages not listed here (calendar picks, review) ignore free text.
+STAGE_HANDLERS = {
+    "awaiting_days": _stage_days,
+    "awaiting_reason": _stage_reason,
+    "awaiting_mass_remarks": _stage_mass_remarks,
+    "awaiting_normal_days": _stage_newuser_normal_days,
+    "ph_ask_count": _stage_newuser_ph_count,
+    "ph_reason": _stage_newuser_ph_reason,
+    "awaiting_app_date_manual": _stage_manual_date,
+    "awaiting_mass_date_manual": _stage_mass_manual_date,
+    "ph_date_manual": _stage_newuser_ph_manual_date,
+}
+
+class InFlowFilter(filters.MessageFilter):
+    """Only users mid-flow (or typing -quit) reach handle_message; other group chatter stops at the filter."""
+    def filter(self, message) -> bool:
+        return bool(message.from_user) and (
+            message.from_user.id in user_state or message.text.strip().lower() == "-quit"
+        )
 
-    # ---- /newuser flow ----
-    if st["flow"] == "newuser":
-        nu = st["newuser"]
-        if st["stage"] == "awaiting_normal_days":
-            try:
-                nd = float(text)
-                if nd < 0:
-                    raise ValueError()
-            except ValueError:
-                await reply_quiet(update, "Please enter a non-negative number (e.g., 0, 6, 7.5).", reply_markup=cancel_keyboard(st["sid"]))
-                return
-            nu["normal_days"] = nd
-            st["stage"] = "ph_ask_count"
-            await reply_quiet(
-                update,
-                "Now we’ll import *PH OIL* entries.\n"
-                "How many PH entries do you want to add? (0–10)\n"
-                "You’ll add them one-by-one with date + PH name.",
-                parse_mode="Markdown",
-                reply_markup=cancel_keyboard(st["sid"])
-            )
-            return
-
-        if st["stage"] == "ph_ask_count":
-            try:
-                cnt = int(text)
-                if cnt < 0 or cnt > 10:
-                    raise ValueError()
-            except ValueError:
-                await reply_quiet(update, "Enter an integer between 0 and 10.", reply_markup=cancel_keyboard(st["sid"]))
-                return
-            nu["ph_count"] = cnt
-            if cnt == 0:
-                st["stage"] = "review_submit"
-                await newuser_review(update, context, st)
-            else:
-                st["ph_idx"] = 0
-                st["stage"] = "ph_date"
-                st["min_date"] = date.today() - timedelta(days=365)
-                st["max_date"] = date.today()
-                cur = date.today()
-                await reply_quiet(
-                    update,
-                    f"PH Entry 1/{nu['ph_count']} — {bold('Select Application Date')} (YYYY-MM-DD)\n"
-                    f"• Allowed date range (clocking): {st['min_date']} to {st['max_date']}",
-                    parse_mode="Markdown",
-                    reply_markup=build_calendar(st["sid"], cur, st["min_date"], st["max_date"])
-                )
-            return
-
-        elif st["stage"] == "ph_reason":
-            idx = st["ph_idx"]
-            txt = text.strip()
-            if not txt or txt.lower() == "nil":
-                await reply_quiet(update, "❌ PH name is required. Please enter the PH name (e.g., National Day 2025).", reply_markup=cancel_keyboard(st["sid"]))
-                return
-            nu["ph_entries"][idx]["reason"] = txt[:80]
-            idx += 1
-            if idx < nu["ph_count"]:
-                st["ph_idx"] = idx
-                st["stage"] = "ph_date"
-                st["min_date"] = date.today() - timedelta(days=365)
-                st["max_date"] = date.today()
-                cur = date.today()
-                await reply_quiet(
-                    update,
-                    f"PH Entry {idx+1}/{nu['ph_count']} — {bold('Select Application Date')} (YYYY-MM-DD)\n"
-                    f"• Allowed date range (clocking): {st['min_date']} to {st['max_date']}",
-                    parse_mode="Markdown",
-                    reply_markup=build_calendar(st["sid"], cur, st["min_date"], st["max_date"])
-                )
-            else:
-                st["stage"] = "review_submit"
-                await newuser_review(update, context, st)
-            return
-
-    # ---- manual date entry (single) ----
-    if st.get("stage") == "awaiting_app_date_manual":
-        d = parse_date_yyyy_mm_dd(text)
-        if not d:
-            await reply_quiet(update, "Invalid date. Please type YYYY-MM-DD.", reply_markup=cancel_keyboard(st["sid"]))
-            return
-        ok, msg = validate_application_date(st.get("action",""), d)
-        if not ok:
-            await reply_quiet(update, msg, reply_markup=cancel_keyboard(st["sid"]))
-            return
-        st["app_date"] = d
-        st["stage"] = "awaiting_reason"
-        if st.get("action") == "clockoff":
-            prompt = "📝 Enter clocking reason (e.g., OT number, event name)."
-        elif st.get("action") == "clockphoff":
-            prompt = "📝 Enter PH name (e.g., National Day 2025)."
-        elif st.get("action") == "claimoff":
-            prompt = "📝 Enter remarks (optional). Type 'nil' to skip."
-        else:
-            prompt = "📝 Enter remarks (optional). Type 'nil' to skip."
-        await reply_quiet(update, prompt, reply_markup=cancel_keyboard(st["sid"]))
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message or not update.message.text:
         return
+    uid = update.effective_user.id
+    text = update.message.text.strip()
 
-    # ---- manual date entry (mass) ----
-    if st.get("stage") == "awaiting_mass_date_manual":
-        d = parse_date_yyyy_mm_dd(text)
-        if not d:
-            await reply_quiet(update, "Invalid date. Please type YYYY-MM-DD.", reply_markup=cancel_keyboard(st["sid"]))
-            return
-        ok, msg = validate_application_date("mass", d)
-        if not ok:
-            await reply_quiet(update, msg, reply_markup=cancel_keyboard(st["sid"]))
-            return
-        st["app_date"] = d
-        st["stage"] = "awaiting_mass_remarks"
-        await reply_quiet(update, "📝 Enter remarks for the mass action (reason or PH name).", reply_markup=cancel_keyboard(st["sid"]))
+    if text.lower() == "-quit":
+        user_state.pop(uid, None)
+        await reply_quiet(update, "🧹 Cancelled.")
         return
 
-    # ---- manual date entry for /newuser PH step ----
-    if st.get("stage") == "ph_date_manual":
-        d = parse_date_yyyy_mm_dd(text)
-        if not d:
-            await reply_quiet(update, "Invalid date. Please type YYYY-MM-DD.", reply_markup=cancel_keyboard(st["sid"]))
-            return
-        ok, msg = validate_application_date("newuser_ph", d)
-        if not ok:
-            await reply_quiet(update, msg, reply_markup=cancel_keyboard(st["sid"]))
-            return
-        nu = st["newuser"]
-        idx = st.get("ph_idx", 0)
-        nu["ph_entries"].append({"date": d, "reason": None})
-        st["stage"] = "ph_reason"
-        await reply_quiet(update, f"PH Entry {idx+1}/{nu['ph_count']} — Enter {bold('PH name')} (max 80 chars):", parse_mode="Markdown", reply_markup=cancel_keyboard(st["sid"]))
+    st = user_state.get(uid)
+    if not st:
         return
+    st["_ts"] = time.monotonic()
+
+    handler = STAGE_HANDLERS.get(st["stage"])
+    if handler:
+        await handler(update, context, st, text)
 
 # -----------------------------------------------------------------------------
 # Callback handler
@@ -845,6 +1249,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     uid = q.from_user.id
     st = user_state.get(uid)
+    if st:
+        st["_ts"] = time.monotonic()
 
     # Only the flow owner can operate inline controls
     def _not_owner_block():
@@ -872,7 +1278,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if kind == "calnav":
         try:
-            target = datetime.strptime(parts[2], "%Y-%m-%d").date()
+            target = _unpack_month(parts[2])
         except Exception:
             target = date.today()
         min_d = st.get("min_date")
@@ -903,18 +1309,17 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if kind == "cal":
-        chosen = parts[2]
+        try:
+            chosen = _unpack_day(parts[2]).isoformat()
+        except (IndexError, ValueError):
+            return
         if st["flow"] in ("normal", "ph") and st["stage"] == "awaiting_app_date":
             ok, msg = validate_application_date(st.get("action",""), chosen)
             if not ok:
                 await q.answer(msg, show_alert=True)
                 return
-            st["app_date"] = chosen
-            try:
-                await q.edit_message_text(f"📅 Application Date: {chosen}")
-            except Exception:
-                pass
-            st["stage"] = "awaiting_reason"
+            # Advance before awaiting so a second tap on the calendar is ignored
+            st.update(app_date=chosen, stage="awaiting_reason")
             if st.get("action") == "clockoff":
                 prompt = "📝 Enter clocking reason (e.g., OT number, event name)."
             elif st.get("action") == "clockphoff":
@@ -924,9 +1329,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 prompt = "📝 Enter remarks (optional). Type 'nil' to skip."
             if update.effective_chat and _is_group(update.effective_chat.type):
-                await send_group_quiet(context, q.message.chat.id, prompt, reply_markup=cancel_keyboard(st["sid"]))
+                send = send_group_quiet(context, q.message.chat.id, prompt, reply_markup=cancel_keyboard(st["sid"]))
             else:
-                await context.bot.send_message(chat_id=q.message.chat.id, text=prompt, reply_markup=cancel_keyboard(st["sid"]))
+                send = context.bot.send_message(chat_id=q.message.chat.id, text=prompt, reply_markup=cancel_keyboard(st["sid"]))
+            # Confirmation edit and next prompt are independent: one round trip instead of two
+            await asyncio.gather(edit_quiet(q, f"📅 Application Date: {chosen}"), send)
             return
 
         if st["flow"].startswith("mass_") and st["stage"] == "awaiting_mass_date":
@@ -934,13 +1341,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not ok:
                 await q.answer(msg, show_alert=True)
                 return
-            st["app_date"] = chosen
-            try:
-                await q.edit_message_text(f"📅 Mass Application Date: {chosen}")
-            except Exception:
-                pass
-            st["stage"] = "awaiting_mass_remarks"
-            await send_group_quiet(context, q.message.chat.id, "📝 Enter remarks for the mass action (reason or PH name).", reply_markup=cancel_keyboard(st["sid"]))
+            st.update(app_date=chosen, stage="awaiting_mass_remarks")
+            await asyncio.gather(
+                edit_quiet(q, f"📅 Mass Application Date: {chosen}"),
+                send_group_quiet(context, q.message.chat.id, "📝 Enter remarks for the mass action (reason or PH name).", reply_markup=cancel_keyboard(st["sid"])),
+            )
             return
 
         if st["flow"] == "newuser" and st["stage"] == "ph_date":
@@ -951,30 +1356,30 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             nu = st["newuser"]
             idx = st["ph_idx"]
             nu["ph_entries"].append({"date": chosen, "reason": None})
-            try:
-                await q.edit_message_text(f"📅 PH Entry {idx+1}/{nu['ph_count']} — Date: {chosen}")
-            except Exception:
-                pass
             st["stage"] = "ph_reason"
-            await send_group_quiet(context, q.message.chat.id, f"PH Entry {idx+1}/{nu['ph_count']} — Enter *PH name* (max 80 chars):", parse_mode="Markdown", reply_markup=cancel_keyboard(sid))
+            await asyncio.gather(
+                edit_quiet(q, f"📅 PH Entry {idx+1}/{nu['ph_count']} — Date: {chosen}"),
+                send_group_quiet(context, q.message.chat.id, f"PH Entry {idx+1}/{nu['ph_count']} — Enter *PH name* (max 80 chars):", parse_mode="Markdown", reply_markup=cancel_keyboard(sid)),
+            )
             return
 
     if kind == "massgo" and st and st.get("stage") == "mass_confirm":
         if _not_owner_block():
             await q.answer("This isn’t your session.", show_alert=True)
             return
+        # Claim the flow before awaiting so a double tap on Proceed sends one request
+        user_state.pop(uid, None)
         await mass_send_to_admins(update, context, st)
         try:
             await q.edit_message_text("Submitted to admins for approval.")
         except Exception:
             pass
-        user_state.pop(uid, None)
         return
 
     # Approve/deny (admin PM)
     if kind in ("approve", "deny"):
         key = parts[1] if len(parts) > 1 else ""
-        payload = pending_payloads.pop(key, None)
+        payload = await pending_pop(key)
         approver = q.from_user.full_name
         approver_id = q.from_user.id
         if not payload:
@@ -984,17 +1389,27 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pass
             return
 
-        if payload.get("type") == "newuser":
-            await handle_newuser_apply(update, context, payload, kind == "approve", approver, approver_id)
-            summary = build_admin_summary_text(payload, approved=(kind=="approve"), approver_name=approver, final_off=None)
+        try:
+            if payload.get("type") == "newuser":
+                await handle_newuser_apply(update, context, payload, kind == "approve", approver, approver_id)
+            elif payload.get("type") == "mass":
+                await handle_mass_apply(context, payload, kind == "approve", approver, approver_id)
+            elif payload.get("type") in ("single",):
+                final_off = await handle_single_apply(update, context, payload, kind == "approve", approver, approver_id)
+        except Exception:
+            # GETDEL already consumed the approval; put it back so the buttons still work
+            log.exception("Failed to apply %s request %s", payload.get("type"), key)
+            await pending_put(key, payload)
             try:
-                await q.edit_message_text(summary)
+                await context.bot.send_message(
+                    chat_id=approver_id,
+                    text="⚠️ Couldn’t write to the sheet. The request is still pending; tap Approve again to retry."
+                )
             except Exception:
                 pass
             return
 
-        if payload.get("type") == "mass":
-            await handle_mass_apply(context, payload, kind == "approve", approver, approver_id)
+        if payload.get("type") in ("newuser", "mass"):
             summary = build_admin_summary_text(payload, approved=(kind=="approve"), approver_name=approver, final_off=None)
             try:
                 await q.edit_message_text(summary)
@@ -1003,12 +1418,6 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         if payload.get("type") in ("single",):
-            await handle_single_apply(update, context, payload, kind == "approve", approver, approver_id)
-            final_off = None
-            if kind == "approve":
-                cur = last_off_for_user(payload["user_id"])
-                calc = cur + (payload["days"] if "clock" in payload["action"] else -payload["days"])
-                final_off = calc
             try:
                 await q.edit_message_text(build_admin_summary_text(payload, approved=(kind=="approve"), approver_name=approver, final_off=final_off))
             except Exception:
@@ -1020,16 +1429,20 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------------------------------------------------------------
 async def finalize_single_request(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str,Any], app_date: str):
     uid = update.effective_user.id
+    uid_s = str(uid)
     user = update.effective_user
     group_id = st.get("group_id") or (update.effective_chat.id if update.effective_chat else None)
+    # Claim the flow before the first await: updates run concurrently, and a
+    # resent reason must not find the state and submit a second request
+    user_state.pop(uid, None)
 
     days = float(st["days"])
     if days <= 0 or not validate_half_step(days):
         await reply_quiet(update, "❌ Days must be positive and in 0.5 steps.")
-        user_state.pop(uid, None)
         return
 
-    current_off = last_off_for_user(str(uid))
+    await refresh_sheet()
+    current_off = last_off_for_user(uid_s)
     add = +days if st["action"] in ("clockoff", "clockphoff") else -days
     final = current_off + add
     is_ph = st["is_ph"]
@@ -1046,18 +1459,14 @@ async def finalize_single_request(update: Update, context: ContextTypes.DEFAULT_
     ph_total_after = ""
     if is_ph:
         if st["action"] == "clockphoff":
-            try:
-                d = datetime.strptime(app_date, "%Y-%m-%d").date()
-                expiry = (d + timedelta(days=365)).strftime("%Y-%m-%d")
-            except Exception:
-                expiry = ""
-        before, _ = compute_ph_entries_active(str(uid))
+            expiry = expiry_from_app_date(app_date)
+        before, _ = compute_ph_entries_active(uid_s)
         ph_total_after = before + (days if st["action"] == "clockphoff" else -days)
 
     key = str(uuid4())[:12]
     payload = {
         "type": "single",
-        "user_id": str(uid),
+        "user_id": uid_s,
         "user_name": user.full_name,
         "group_id": group_id,
         "action": st["action"],
@@ -1074,62 +1483,39 @@ async def finalize_single_request(update: Update, context: ContextTypes.DEFAULT_
 
     # send to admins and store PM refs
     try:
-        admins = await context.bot.get_chat_administrators(group_id)
+        admins = await get_admins(context, group_id)
     except Exception:
         admins = []
 
-    kb = InlineKeyboardMarkup([[
-        InlineKeyboardButton("✅ Approve", callback_data=f"approve|{key}"),
-        InlineKeyboardButton("❌ Deny", callback_data=f"deny|{key}")
-    ]])
+    kb = approval_keyboard(key)
 
-    label = (
-        "Clock Off" if st["action"]=="clockoff" else
-        "Claim Off" if st["action"]=="claimoff" else
-        "Clock Off (PH)" if st["action"]=="clockphoff" else
-        "Claim Off (PH)"
-    )
+    label = REQUEST_LABELS[st["action"]]
 
-    text = (
-        f"🆕 *{label} Request*\n\n"
-        f"👤 User: {user.full_name} ({uid})\n"
-        f"📅 Days: {days}\n"
-        f"🗓 Application Date: {app_date}\n"
-        f"📝 Reason: {st.get('reason','') or '—'}\n\n"
-        f"📊 Current Off: {current_off:.1f}\n"
-        f"📈 New Balance: {final:.1f}"
+    text = ADMIN_SINGLE_TMPL.format(
+        label=label, name=user.full_name, uid=uid, days=days, app_date=app_date,
+        reason=st.get("reason", "") or "—", current=current_off, final=final,
     )
     if is_ph and expiry:
         text += f"\n🏖 PH Expiry: {expiry}"
         if payload.get("ph_total_after") is not None:
             text += f"\n🏖 PH Total After: {payload['ph_total_after']:.1f}"
 
-    sent_any = False
-    admin_msgs = []
-    for a in admins:
-        if a.user.is_bot:
-            continue
-        try:
-            msg = await context.bot.send_message(chat_id=a.user.id, text=text, parse_mode="Markdown", reply_markup=kb)
-            admin_msgs.append((a.user.id, msg.message_id))
-            sent_any = True
-        except Exception:
-            pass
+    admin_msgs = await pm_admins(context, admins, [text], parse_mode="Markdown", reply_markup=kb)
+    sent_any = bool(admin_msgs)
 
     payload["admin_msgs"] = admin_msgs
-    pending_payloads[key] = payload
+    await pending_put(key, payload)
 
     if sent_any:
         await send_group_quiet(context, group_id, "📩 Request submitted to admins for approval.")
     else:
         await send_group_quiet(context, group_id, "⚠️ Could not reach any admin. Please ensure the bot can PM admins.")
 
-    user_state.pop(uid, None)
-
 # -----------------------------------------------------------------------------
 # Apply single (admin approve/deny) + send receipts + edit all admin PMs
 # -----------------------------------------------------------------------------
-async def handle_single_apply(update: Update, context: ContextTypes.DEFAULT_TYPE, p: Dict[str,Any], approved: bool, approver_name: str, approver_id: int):
+async def handle_single_apply(update: Update, context: ContextTypes.DEFAULT_TYPE, p: Dict[str,Any], approved: bool, approver_name: str, approver_id: int) -> Optional[float]:
+    """Apply (or deny) a single request; returns the written Final Off when approved. Raises if the write fails."""
     gid = p.get("group_id")
     uid = p["user_id"]
     uname = p["user_name"]
@@ -1146,23 +1532,24 @@ async def handle_single_apply(update: Update, context: ContextTypes.DEFAULT_TYPE
         except Exception:
             pass
         summary = build_admin_summary_text(p, approved=False, approver_name=approver_name, final_off=None)
-        await update_all_admin_pm(context, p, summary)
-        return
+        await update_all_admin_pm(context, p, summary, skip_id=approver_id)
+        return None
 
-    current_off = last_off_for_user(uid)
-    add = +days if "clock" in action else -days
-    final = current_off + add
+    async with sheet_write_lock:
+        await _snapshot_for_write()
+        current_off = last_off_for_user(uid)
+        add = +days if "clock" in action else -days
+        final = current_off + add
 
-    ph_total_left, _ = compute_ph_entries_active(uid)
-    ph_total_after = ph_total_left + (days if action == "clockphoff" else (-days if action == "claimphoff" else 0))
-    if not is_ph:
-        ph_total_after = 0.0
+        ph_total_left, _ = compute_ph_entries_active(uid)
+        ph_total_after = ph_total_left + (days if action == "clockphoff" else (-days if action == "claimphoff" else 0))
+        if not is_ph:
+            ph_total_after = 0.0
 
-    try:
-        append_row(
+        write = await queue_rows([build_row(
             user_id=uid,
             user_name=uname,
-            action=("Clock Off" if action.startswith("clock") else "Claim Off"),
+            action=SHEET_ACTIONS[action],
             current_off=current_off,
             add_subtract=add,
             final_off=final,
@@ -1172,16 +1559,12 @@ async def handle_single_apply(update: Update, context: ContextTypes.DEFAULT_TYPE
             is_ph=is_ph,
             ph_total=ph_total_after if is_ph else 0.0,
             expiry=expiry if is_ph else ""
-        )
-    except Exception:
-        log.exception("Failed to append row for single apply")
-
-    msg = (
-        f"✅ {uname}'s {('PH ' if is_ph else '')}{'Clock Off' if 'clock' in action else 'Claim Off'} approved by {approver_name}.\n"
-        f"🗓 Application Date: {app_date}\n"
-        f"📅 Days: {days}\n"
-        f"📝 Reason: {reason or '—'}\n"
-        f"📊 Final: {final:.1f} day(s)"
+        )])
+    await write
+
+    msg = GROUP_SINGLE_APPROVED_TMPL.format(
+        name=uname, ph="PH " if is_ph else "", label=SHEET_ACTIONS[action],
+        approver=approver_name, app_date=app_date, days=days, reason=reason or "—", final=final,
     )
     if is_ph and expiry:
         msg += f"\n🏖 PH Expiry: {expiry}"
@@ -1191,20 +1574,20 @@ async def handle_single_apply(update: Update, context: ContextTypes.DEFAULT_TYPE
         pass
 
     summary = build_admin_summary_text(p, approved=True, approver_name=approver_name, final_off=final)
-    await update_all_admin_pm(context, p, summary)
+    await update_all_admin_pm(context, p, summary, skip_id=approver_id)
+    return final
 
 # -----------------------------------------------------------------------------
 # Mass preview & apply
 # -----------------------------------------------------------------------------
 async def mass_preview_and_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, st: Dict[str, Any]):
     chat_id = st["group_id"]
+    await refresh_sheet()
     rows = get_all_rows()
     seen = {}
     for r in rows[1:]:
-        if len(r) < 3:
-            continue
-        tid = r[1].strip()
-        name = r[2].strip()
+        tid = r[COL_TG_ID].strip()
+        name = r[COL_NAME].strip()
         if not tid.isdigit():
             continue
         seen[tid] = name or tid
@@ -1213,17 +1596,23 @@ async def mass_preview_and_confirm(update: Update, context: ContextTypes.DEFAULT
         user_state.pop(update.effective_user.id, None)
         return
 
-    listing = "\n".join([f"- {n} ({t})" for t, n in seen.items()])
+    chunks = chunk_lines([f"- {n} ({t})" for t, n in seen.items()])
     st["mass_targets"] = [{"user_id": t, "name": n} for t, n in seen.items()]
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Proceed", callback_data=f"massgo|{st['sid']}"),
                                 InlineKeyboardButton("❌ Cancel", callback_data=f"cancel|{st['sid']}")]])
-    await send_group_quiet(
-        context,
-        chat_id,
-        f"🔍 *Dry-run preview* ({len(seen)} users)\nDays per user: {st['days']}\nDate: {st.get('app_date','')}\nRemarks: {st.get('reason','')}\n\n{listing}",
-        parse_mode="Markdown",
-        reply_markup=kb
+    chunks[0] = (
+        f"🔍 *Dry-run preview* ({len(seen)} users)\nDays per user: {st['days']}\n"
+        f"Date: {st.get('app_date','')}\nRemarks: {st.get('reason','')}\n\n{chunks[0]}"
     )
+    # Long listings go out as several messages, in order; the buttons ride on the last one
+    for i, chunk in enumerate(chunks, 1):
+        await send_group_quiet(
+            context,
+            chat_id,
+            chunk,
+            parse_mode="Markdown",
+            reply_markup=kb if i == len(chunks) else None
+        )
     st["stage"] = "mass_confirm"
 
 async def cmd_massclockoff(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1232,7 +1621,7 @@ async def cmd_massclockoff(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Run this in the group you want to affect.")
         return
     try:
-        admins = await context.bot.get_chat_administrators(chat.id)
+        admins = await get_admins(context, chat.id)
         if update.effective_user.id not in [a.user.id for a in admins if not a.user.is_bot]:
             await reply_quiet(update, "Only admins can use this.")
             return
@@ -1262,7 +1651,7 @@ async def cmd_massclockphoff(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Run this in the group you want to affect.")
         return
     try:
-        admins = await context.bot.get_chat_administrators(chat.id)
+        admins = await get_admins(context, chat.id)
         if update.effective_user.id not in [a.user.id for a in admins if not a.user.is_bot]:
             await reply_quiet(update, "Only admins can use this.")
             return
@@ -1295,12 +1684,6 @@ async def newuser_review(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
     uname = update.effective_user.full_name
     gid = st["group_id"]
 
-    lines = [f"👤 {uname} ({uid})"]
-    lines.append(f"Normal OIL days to import: {nu['normal_days']}")
-    lines.append(f"PH entries: {len(nu['ph_entries'])}")
-    for e in nu["ph_entries"]:
-        lines.append(f"  • {e['date']} — {e['reason']}")
-
     key = str(uuid4())[:12]
     payload = {
         "type": "newuser",
@@ -1312,29 +1695,22 @@ async def newuser_review(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
         "admin_msgs": []
     }
 
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Approve", callback_data=f"approve|{key}"),
-                                InlineKeyboardButton("❌ Deny", callback_data=f"deny|{key}")]])
+    kb = approval_keyboard(key)
 
-    txt = "🔎 *Import Review*\n" + "\n".join(lines)
+    txt = ADMIN_ONBOARD_TMPL.format(
+        name=uname, uid=uid, nd=nu["normal_days"], nph=len(nu["ph_entries"]),
+        lines="".join([f"\n  • {e['date']} — {e['reason']}" for e in nu["ph_entries"]]),
+    )
 
     try:
-        admins = await context.bot.get_chat_administrators(gid)
+        admins = await get_admins(context, gid)
     except Exception:
         admins = []
-    sent = False
-    admin_msgs = []
-    for a in admins:
-        if a.user.is_bot:
-            continue
-        try:
-            msg = await context.bot.send_message(chat_id=a.user.id, text=txt, parse_mode="Markdown", reply_markup=kb)
-            admin_msgs.append((a.user.id, msg.message_id))
-            sent = True
-        except Exception:
-            pass
+    admin_msgs = await pm_admins(context, admins, [txt], parse_mode="Markdown", reply_markup=kb)
+    sent = bool(admin_msgs)
 
     payload["admin_msgs"] = admin_msgs
-    pending_payloads[key] = payload
+    await pending_put(key, payload)
 
     if sent:
         if via_edit:
@@ -1361,50 +1737,44 @@ async def handle_newuser_apply(update: Update, context: ContextTypes.DEFAULT_TYP
         except Exception:
             pass
         summary = build_admin_summary_text(p, approved=False, approver_name=approver_name, final_off=None)
-        await update_all_admin_pm(context, p, summary)
-        return
+        await update_all_admin_pm(context, p, summary, skip_id=approver_id)
+        return None
 
-    if normal_days > 0:
+    async with sheet_write_lock:
+        await _snapshot_for_write()
+        # Running balances are tracked here so every imported row goes out in one append
         current = last_off_for_user(uid)
-        add = +normal_days
-        final = current + add
-        try:
-            append_row(
+        ph_total, _ = compute_ph_entries_active(uid)
+        batch = []
+        if normal_days > 0:
+            final = current + normal_days
+            batch.append(build_row(
                 user_id=uid,
                 user_name=uname,
                 action="Clock Off",
                 current_off=current,
-                add_subtract=add,
+                add_subtract=normal_days,
                 final_off=final,
                 approved_by=approver_name,
-                application_date=date.today().strftime("%Y-%m-%d"),
+                application_date=date.today().isoformat(),
                 remarks="Transfer from old record",
                 is_ph=False,
                 ph_total=0.0,
                 expiry=""
-            )
-        except Exception:
-            log.exception("Failed to append normal import for newuser")
-
-    for e in ph_entries:
-        dstr = e.get("date")
-        reason = e.get("reason", "")
-        if not dstr:
-            continue
-        current = last_off_for_user(uid)
-        add = +1.0
-        final = current + add
-        d = parse_date_yyyy_mm_dd(dstr)
-        exp = ""
-        try:
-            dt = datetime.strptime(dstr, "%Y-%m-%d").date()
-            exp = (dt + timedelta(days=365)).strftime("%Y-%m-%d")
-        except Exception:
-            pass
-        before, _ = compute_ph_entries_active(uid)
-        ph_after = before + 1.0
-        try:
-            append_row(
+            ))
+            current = final
+
+        for e in ph_entries:
+            dstr = e.get("date")
+            reason = e.get("reason", "")
+            if not dstr:
+                continue
+            add = +1.0
+            final = current + add
+            d = parse_date_yyyy_mm_dd(dstr)
+            exp = expiry_from_app_date(dstr)
+            ph_total += 1.0
+            batch.append(build_row(
                 user_id=uid,
                 user_name=uname,
                 action="Clock Off",
@@ -1412,14 +1782,16 @@ async def handle_newuser_apply(update: Update, context: ContextTypes.DEFAULT_TYP
                 add_subtract=add,
                 final_off=final,
                 approved_by=approver_name,
-                application_date=d or date.today().strftime("%Y-%m-%d"),
+                application_date=d or date.today().isoformat(),
                 remarks=reason,
                 is_ph=True,
-                ph_total=ph_after,
+                ph_total=ph_total,
                 expiry=exp
-            )
-        except Exception:
-            log.exception("Failed to append PH import for newuser")
+            ))
+            current = final
+
+        write = await queue_rows(batch)
+    await write
 
     try:
         await send_group_quiet(context, gid, f"✅ Onboarding import for {uname} approved by {approver_name}.")
@@ -1427,7 +1799,7 @@ async def handle_newuser_apply(update: Update, context: ContextTypes.DEFAULT_TYP
         pass
 
     summary = build_admin_summary_text(p, approved=True, approver_name=approver_name, final_off=None)
-    await update_all_admin_pm(context, p, summary)
+    await update_all_admin_pm(context, p, summary, skip_id=approver_id)
 
 # -----------------------------------------------------------------------------
 # Mass apply
@@ -1450,36 +1822,26 @@ async def mass_send_to_admins(update: Update, context: ContextTypes.DEFAULT_TYPE
         "app_date": st.get("app_date",""),
     }
 
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Approve", callback_data=f"approve|{key}"),
-                                InlineKeyboardButton("❌ Deny", callback_data=f"deny|{key}")]])
+    kb = approval_keyboard(key)
 
     label = "Mass Clock PH" if is_ph else "Mass Clock"
-    listing = "\n".join([f"- {t['name']} ({t['user_id']})" for t in targets])
-    txt = (
-        f"🆕 *{label}* — Days per user: {days}\n"
-        f"🗓 Date: {payload['app_date']}\n"
-        f"📝 Remarks: {payload['reason']}\n\n"
-        f"{listing}\n\nProceed?"
+    # Same 4096-char limit as the group preview: split the roster, buttons on the last PM
+    chunks = chunk_lines([f"- {t['name']} ({t['user_id']})" for t in targets])
+    chunks[0] = ADMIN_MASS_TMPL.format(
+        label=label, days=days, app_date=payload["app_date"],
+        reason=payload["reason"], listing=chunks[0],
     )
+    chunks[-1] += "\n\nProceed?"
 
     try:
-        admins = await context.bot.get_chat_administrators(gid)
+        admins = await get_admins(context, gid)
     except Exception:
         admins = []
-    sent = False
-    admin_msgs = []
-    for a in admins:
-        if a.user.is_bot:
-            continue
-        try:
-            msg = await context.bot.send_message(chat_id=a.user.id, text=txt, parse_mode="Markdown", reply_markup=kb)
-            admin_msgs.append((a.user.id, msg.message_id))
-            sent = True
-        except Exception:
-            pass
+    admin_msgs = await pm_admins(context, admins, chunks, parse_mode="Markdown", reply_markup=kb)
+    sent = bool(admin_msgs)
 
     payload["admin_msgs"] = admin_msgs
-    pending_payloads[key] = payload
+    await pending_put(key, payload)
 
     if sent:
         await send_group_quiet(context, gid, "📩 Mass request sent to admins.")
@@ -1499,27 +1861,31 @@ async def handle_mass_apply(context: ContextTypes.DEFAULT_TYPE, p: Dict[str,Any]
         except Exception:
             pass
         summary = build_admin_summary_text(p, approved=False, approver_name=approver_name, final_off=None)
-        await update_all_admin_pm(context, p, summary)
-        return
-
-    count_ok = 0
-    for t in targets:
-        uid = t["user_id"]
-        uname = t["name"]
-        current_off = last_off_for_user(uid)
-        add = +days
-        final = current_off + add
-
-        expiry = ""
-        ph_total_after = 0.0
-        if is_ph:
-            today = date.today()
-            expiry = (today + timedelta(days=365)).strftime("%Y-%m-%d")
-            before, _ = compute_ph_entries_active(uid)
-            ph_total_after = before + days
+        await update_all_admin_pm(context, p, summary, skip_id=approver_id)
+        return None
 
-        try:
-            append_row(
+    async with sheet_write_lock:
+        await _snapshot_for_write()
+        index = get_sheet_index()
+        by_user = index["by_user"]
+        last_final_by_user = index["last_final_by_user"]
+
+        batch = []
+        for t in targets:
+            uid = t["user_id"]
+            uname = t["name"]
+            current_off = last_final_by_user.get(uid, 0.0)
+            add = +days
+            final = current_off + add
+
+            expiry = ""
+            ph_total_after = 0.0
+            if is_ph:
+                expiry = expiry_from_app_date(date.today().isoformat())
+                before, _ = compute_ph_entries_active(uid, by_user.get(uid, []))
+                ph_total_after = before + days
+
+            batch.append(build_row(
                 user_id=uid,
                 user_name=uname,
                 action="Clock Off",
@@ -1527,59 +1893,102 @@ async def handle_mass_apply(context: ContextTypes.DEFAULT_TYPE, p: Dict[str,Any]
                 add_subtract=add,
                 final_off=final,
                 approved_by=approver_name,
-                application_date=p.get("app_date", date.today().strftime("%Y-%m-%d")),
+                application_date=p.get("app_date", date.today().isoformat()),
                 remarks=p.get("reason","Mass clock"),
                 is_ph=is_ph,
                 ph_total=ph_total_after if is_ph else 0.0,
                 expiry=expiry if is_ph else ""
-            )
-            count_ok += 1
-        except Exception:
-            log.exception("Mass append failed for %s", uid)
+            ))
+
+        write = await queue_rows(batch)
+    await write
 
     try:
-        await send_group_quiet(context, gid, f"✅ {label} approved by {approver_name}. Processed {count_ok}/{len(targets)} users.")
+        await send_group_quiet(context, gid, f"✅ {label} approved by {approver_name}. Processed {len(batch)}/{len(targets)} users.")
     except Exception:
         pass
 
     summary = build_admin_summary_text(p, approved=True, approver_name=approver_name, final_off=None)
-    await update_all_admin_pm(context, p, summary)
+    await update_all_admin_pm(context, p, summary, skip_id=approver_id)
 
 # -----------------------------------------------------------------------------
 # Webhook endpoints
 # -----------------------------------------------------------------------------
-@app.route("/")
-def index():
-    return "✅ Oil Tracking Bot is up."
-
-@app.route("/health")
-def health():
-    return "✅ Health check passed."
-
-@app.route(f"/{BOT_TOKEN}", methods=["POST"])
-def webhook():
-    global telegram_app
-    if telegram_app is None:
-        return "Bot not ready", 503
-
-    try:
-        update = Update.de_json(request.get_json(force=True), telegram_app.bot)
-        log.info(f"📨 Incoming update: {request.get_json(force=True)}")
-        future = asyncio.run_coroutine_threadsafe(telegram_app.process_update(update), loop)
-        future.add_done_callback(lambda f: f.exception())
-        return "OK"
-    except Exception:
-        log.exception("Error processing update")
-        return "Internal Server Error", 500
+# Served by tornado (shipped with python-telegram-bot[webhooks]) on the same
+# event loop as the bot: no thread hop between the HTTP request and PTB.
+class TextHandler(tornado.web.RequestHandler):
+    def initialize(self, body: bytes):
+        self.body = body
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; charset=UTF-8")
+        self.write(self.body)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        # Same public host as the webhook, so callers must present METRICS_TOKEN
+        if not hmac.compare_digest(
+            self.request.headers.get("Authorization", "").encode(), f"Bearer {METRICS_TOKEN}".encode()
+        ):
+            self.set_status(403)
+            return
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(render_metrics())
+
+class WebhookHandler(tornado.web.RequestHandler):
+    async def post(self):
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+            self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(), WEBHOOK_SECRET.encode()
+        ):
+            self.set_status(403)
+            return
+        try:
+            payload = orjson.loads(self.request.body)
+            update = Update.de_json(payload, telegram_app.bot)
+        except Exception:
+            log.exception("Error decoding update")
+            self.set_status(400)
+            return
+        log.debug("📨 Incoming update: %s", payload)
+        # Ack right away; the Application drains update_queue on its own tasks
+        await telegram_app.update_queue.put(update)
+        self.set_header("Content-Type", "text/plain; charset=UTF-8")
+        self.write(b"OK")
+
+def make_web_app() -> tornado.web.Application:
+    routes = [
+        (r"/", TextHandler, {"body": "✅ Oil Tracking Bot is up.".encode()}),
+        (r"/health", TextHandler, {"body": "✅ Health check passed.".encode()}),
+        (rf"/{BOT_TOKEN}", WebhookHandler),
+    ]
+    if METRICS_TOKEN:
+        routes.append((r"/metrics", MetricsHandler))
+    return tornado.web.Application(routes)
 
 # -----------------------------------------------------------------------------
 # Init & run
 # -----------------------------------------------------------------------------
-async def init_app():
-    global telegram_app, worksheet
+def init_app():
+    """
+    Build the PTB Application. concurrent_updates lets slow handlers
+    (Sheets I/O, admin fan-out) overlap instead of queueing behind each other.
+    """
+    global telegram_app, redis_client
     gsheet_init()
-
-    telegram_app = ApplicationBuilder().token(BOT_TOKEN).get_updates_http_version("1.1").build()
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL)
+        log.info("🗄 Pending approvals stored in Redis.")
+
+    telegram_app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # Admin PM fan-outs multiplex over a few HTTP/2 connections instead of a TLS handshake each
+        .http_version("2")
+        # Token-bucket on Bot API calls (30/s overall, 20/min per group); retries 429s after retry_after
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .concurrent_updates(True)
+        .build()
+    )
 
     telegram_app.add_handler(CommandHandler("help", cmd_help))
     telegram_app.add_handler(CommandHandler("startadmin", cmd_startadmin))
@@ -1597,17 +2006,43 @@ async def init_app():
 
     telegram_app.add_handler(CommandHandler("newuser", cmd_newuser))
 
-    telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & InFlowFilter(), handle_message))
     telegram_app.add_handler(CallbackQueryHandler(handle_callback))
-
-    await telegram_app.initialize()
-    await telegram_app.bot.set_webhook(url=f"{WEBHOOK_URL}/{BOT_TOKEN}")
-    log.info("🚀 Webhook set.")
+    telegram_app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
+
+async def serve():
+    # docker stop sends SIGTERM; turn it (and Ctrl-C) into an orderly shutdown
+    # so queued sheet rows are flushed instead of dropped with the process
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with telegram_app:
+        await telegram_app.start()
+        writer = asyncio.create_task(sheet_writer())
+        sweeper = asyncio.create_task(sweep_user_state())
+        # Listen before registering the webhook so Telegram's first deliveries find the port open
+        server = make_web_app().listen(10000, address="0.0.0.0")
+        log.info("🟢 Listening on :10000")
+        try:
+            await telegram_app.bot.set_webhook(
+                url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=WEBHOOK_SECRET or None,
+            )
+            log.info("🚀 Webhook set.")
+            await stop.wait()
+            log.info("🛑 Shutting down.")
+        finally:
+            server.stop()
+            await telegram_app.stop()
+            await _write_q.join()
+            writer.cancel()
+            sweeper.cancel()
 
 if __name__ == "__main__":
-    nest_asyncio.apply()
-    import threading
-    threading.Thread(target=loop.run_forever, daemon=True).start()
-    loop.call_soon_threadsafe(lambda: asyncio.ensure_future(init_app()))
-    log.info("🟢 Starting Flask…")
-    app.run(host="0.0.0.0", port=10000)
+    init_app()
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(serve())